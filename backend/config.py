@@ -20,14 +20,26 @@ RAW_DATA_DIR = BASE_DIR.parent / "data" / "raw_data"
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_ROOT.mkdir(exist_ok=True)
 
+# Audio formats picked up in song folders
+AUDIO_EXTENSIONS = frozenset({".mp3", ".wav", ".ogg", ".m4a", ".flac"})
+
 # Song Database JSON Path
 SONG_DATABASE_PATH = BASE_DIR / "songs_database.json"
 
+# Cached pitch contours and song features
+# (see dsp_utils.extract_pitch, melody.extract_features_from_file)
+PITCH_CACHE_DIR = BASE_DIR / ".pitch_cache"
+
 # Audio Settings (from qtune_processor.py)
 SAMPLE_RATE = 22050
 HOP_LENGTH = 512
 n_fft = 2048
 
+# Pitch tracker for dsp_utils.extract_pitch: "pyin" (librosa) or
+# "pyworld" (WORLD DIO, much faster for bulk indexing; needs pyworld)
+PITCH_BACKEND = "pyin"
+
 # Ensure directories exist
 (MEDIA_ROOT / "songs").mkdir(exist_ok=True)
 (MEDIA_ROOT / "uploads").mkdir(exist_ok=True)
+PITCH_CACHE_DIR.mkdir(exist_ok=True)
@@ -8,57 +8,296 @@ Robust pitch extraction with:
 4. Interval representation
 """
 
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+
 import librosa
+import numba
 import numpy as np
-from scipy.signal import medfilt
+import soundfile as sf
+import soxr
+from scipy.ndimage import median_filter
+
+from backend.config import PITCH_BACKEND, PITCH_CACHE_DIR
+from backend.services._dtw_kernel import banded_dtw
+
+# pYIN search range
+FMIN_NOTE = 'C2'
+FMAX_NOTE = 'C6'
+FMIN_HZ = librosa.note_to_hz(FMIN_NOTE)
+FMAX_HZ = librosa.note_to_hz(FMAX_NOTE)
+
+# pYIN framing. 1024 samples still spans >2 periods of C2;
+# the hop is pinned rather than left at pyin's frame_length // 4.
+FRAME_LENGTH = 1024
+HOP_LENGTH = 512
+
+# Pitch-only analysis rate. Nyquist at 8 kHz is far above FMAX_NOTE,
+# and pYIN cost scales with the number of samples.
+PITCH_SR = 16000
+
+# Silence gate: frame RMS threshold and the share of frames that must pass
+SILENCE_RMS = 0.003
+MIN_ACTIVE_FRACTION = 0.1
 
+# Cached contours are stored as int8 in 1/PITCH_QUANT_STEPS semitones
+# (quarter-semitone resolution, +/-31 semitones range)
+PITCH_QUANT_STEPS = 4
 
-def extract_pitch(file_path, sr=22050):
+
+@numba.njit(cache=True)
+def _viterbi_sparse(log_prob, log_p_init, indptr, indices, log_trans):
     """
-    Extract clean pitch track from audio.
-    For best results, use isolated vocals (not full mix).
+    Viterbi decoding over a sparse (CSC) transition matrix.
+    Predecessors of state j are indices[indptr[j]:indptr[j + 1]].
+    """
+    n_steps, n_states = log_prob.shape
+
+    state = np.zeros(n_steps, dtype=np.uint16)
+    ptr = np.zeros((n_steps, n_states), dtype=np.uint16)
+    prev = log_prob[0] + log_p_init
+    curr = np.empty(n_states)
+
+    for t in range(1, n_steps):
+        for j in range(n_states):
+            best = -np.inf
+            best_k = 0
+            for k in range(indptr[j], indptr[j + 1]):
+                v = prev[indices[k]] + log_trans[k]
+                if v > best:
+                    best = v
+                    best_k = indices[k]
+            ptr[t, j] = best_k
+            curr[j] = log_prob[t, j] + best
+        prev, curr = curr, prev
+
+    state[-1] = np.argmax(prev)
+    for t in range(n_steps - 2, -1, -1):
+        state[t] = ptr[t + 1, state[t + 1]]
+
+    return state
+
+
+_dense_viterbi = librosa.sequence.viterbi
+
+
+def _viterbi(prob, transition, *, p_init=None, return_logp=False):
+    """
+    Drop-in for librosa.sequence.viterbi that skips zero transitions.
+    pYIN's transition matrix is block-banded (roughly 15-30% non-zero,
+    depending on the note range and sample rate), and the sparse step's
+    cost scales with the non-zeros rather than states^2.
     """
+    if return_logp:
+        return _dense_viterbi(prob, transition, p_init=p_init, return_logp=return_logp)
+    nonzero = transition.T > 0
+
+    n_states, n_steps = prob.shape[-2:]
+    if p_init is None:
+        p_init = np.full(n_states, 1.0 / n_states)
+
+    epsilon = librosa.util.tiny(prob)
+    dest, src = np.nonzero(nonzero)
+    indptr = np.searchsorted(dest, np.arange(n_states + 1))
+    log_trans = np.log(transition[src, dest] + epsilon)
+    log_p_init = np.log(p_init + epsilon)
+
+    log_prob = np.log(prob + epsilon).reshape(-1, n_states, n_steps)
+    states = np.stack([
+        _viterbi_sparse(np.ascontiguousarray(lp.T), log_p_init, indptr, src, log_trans)
+        for lp in log_prob
+    ])
+    return states.reshape(prob.shape[:-2] + (n_steps,))
+
+
+# librosa.pyin decodes with librosa.sequence.viterbi; route it through
+# the sparse version so every pyin call in this process benefits.
+librosa.sequence.viterbi = _viterbi
+
+
+def _pitch_cache_path(file_path, sr):
+    """
+    Cache file for a pitch contour. Keyed on the file's mtime and the
+    extraction settings, so edits or config changes miss the cache.
+    """
+    file_path = Path(file_path)
+    key = (
+        f"{file_path.resolve()}:{file_path.stat().st_mtime_ns}:{sr}:"
+        f"{FMIN_NOTE}:{FMAX_NOTE}:{FRAME_LENGTH}:{HOP_LENGTH}:{PITCH_BACKEND}:"
+        f"q{PITCH_QUANT_STEPS}"
+    )
+    return PITCH_CACHE_DIR / f"{hashlib.sha1(key.encode()).hexdigest()}.npy"
+
+
+def _read_pitch_cache(cache_path):
+    """Cached int8 contour, or None on a miss or an unreadable (e.g. truncated) file."""
     try:
-        print(f"   [DEBUG] Processing: {file_path}")
-        # 1. Load audio
-        y, sr = librosa.load(file_path, sr=sr, mono=True)
-        
-        # Silence check
-        rms = librosa.feature.rms(y=y)
-        if np.mean(rms) < 0.003:
-            print("   [WARN] Audio too quiet")
-            return None
+        return np.load(cache_path)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, EOFError) as e:
+        print(f"   [CACHE] Ignoring unreadable {cache_path.name}: {e}")
+        return None
+
+
+def _write_pitch_cache(cache_path, midi_q):
+    """Write then rename, so a killed run never leaves a partial .npy behind."""
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix='.npy.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, midi_q, allow_pickle=False)
+        os.replace(tmp_path, cache_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+@numba.njit(cache=True, fastmath=True)
+def _normalize_midi(f0, lo, hi):
+    """
+    Clip f0 (Hz) to [lo, hi], convert to MIDI and zero-center.
+    Two passes and a single float32 output, no temporaries.
+    """
+    n = f0.shape[0]
+    out = np.empty(n, dtype=np.float32)
+    total = 0.0
+    for i in range(n):
+        f = min(max(f0[i], lo), hi)
+        m = 12.0 * np.log2(f / 440.0) + 69.0
+        out[i] = m
+        total += m
+    mean = total / n
+    for i in range(n):
+        out[i] -= mean
+    return out
 
-        # 2. Extract pitch using pYIN
+
+def _load_audio(file_path, sr):
+    """
+    Decode straight through libsndfile and resample with soxr, skipping
+    librosa.load's audioread path. Formats libsndfile can't read fall
+    back to librosa.
+    """
+    try:
+        y, sr_orig = sf.read(file_path, dtype='float32', always_2d=False)
+    except (sf.LibsndfileError, RuntimeError):
+        y, _ = librosa.load(file_path, sr=sr, mono=True)
+        return y.astype(np.float32, copy=False)
+
+    if y.ndim == 2:
+        y = y.mean(axis=1)
+    if sr_orig != sr:
+        y = soxr.resample(y, sr_orig, sr, quality='HQ')
+    return np.ascontiguousarray(y, dtype=np.float32)
+
+
+def _f0_pyworld(y, sr):
+    """
+    F0 track via WORLD's DIO + StoneMask (C implementation).
+    Much faster than pYIN for bulk indexing; unvoiced frames become NaN
+    to match pyin's output.
+    """
+    import pyworld as pw
+
+    y = y.astype(np.float64)
+    f0, t = pw.dio(
+        y, sr,
+        f0_floor=FMIN_HZ,
+        f0_ceil=FMAX_HZ,
+        frame_period=1000 * HOP_LENGTH / sr
+    )
+    f0 = pw.stonemask(y, f0, t, sr)
+    f0[f0 <= 0] = np.nan
+    return f0
+
+
+def extract_contour(y, sr=PITCH_SR):
+    """
+    Clean, zero-centred MIDI contour (float32) from a mono signal,
+    or None if there is no usable melody. Works on in-memory audio;
+    extract_pitch wraps it with file loading and the disk cache.
+    """
+    # Silence check (before pYIN, which dominates the cost)
+    if len(y) == 0:
+        print("   [SKIP] empty")
+        return None
+    
+    rms = librosa.feature.rms(y=y)[0]
+    if np.mean(rms) < SILENCE_RMS:
+        print("   [WARN] Audio too quiet")
+        return None
+    
+    # Mostly-silent tracks (e.g. instrumentals) have no melody to find
+    if np.mean(rms > SILENCE_RMS) < MIN_ACTIVE_FRACTION:
+        print("   [SKIP] Too few non-silent frames")
+        return None
+
+    # 2. Extract pitch (pYIN by default)
+    if PITCH_BACKEND == "pyworld":
+        f0 = _f0_pyworld(y, sr)
+    else:
+        # Sung melodies rarely go above C6; a tighter fmax shrinks the
+        # pYIN pitch-state space (and the Viterbi work with it).
         f0, voiced_flag, voiced_probs = librosa.pyin(
             y, 
-            fmin=librosa.note_to_hz('C2'), 
-            fmax=librosa.note_to_hz('C7')
+            fmin=FMIN_HZ, 
+            fmax=FMAX_HZ,
+            sr=sr,
+            frame_length=FRAME_LENGTH,
+            hop_length=HOP_LENGTH
         )
+    
+    # 3. Keep ONLY voiced frames (remove NaNs)
+    valid_mask = ~np.isnan(f0)
+    f0_clean = f0[valid_mask]
+    
+    if len(f0_clean) < 15:
+        print(f"   [WARN] Melody too short ({len(f0_clean)} frames)")
+        return None
+    
+    # 4. Median filter (removes jitter + vibrato)
+    kernel_size = min(5, len(f0_clean) if len(f0_clean) % 2 == 1 else len(f0_clean) - 1)
+    if kernel_size >= 3:
+        f0_clean = median_filter(f0_clean, size=kernel_size, mode='nearest')
+    
+    # 5-7. Remove outliers (octave errors), convert to MIDI, zero-center.
+    # hz -> MIDI is monotonic, so the percentile bounds can be taken in Hz;
+    # one O(n) partition selects both order statistics.
+    n = len(f0_clean)
+    k5, k95 = int(0.05 * (n - 1)), int(0.95 * (n - 1))
+    p5, p95 = np.partition(f0_clean, (k5, k95))[[k5, k95]]
+    return _normalize_midi(f0_clean, p5, p95)
+
+
+def extract_pitch(file_path, sr=PITCH_SR):
+    """
+    Extract clean pitch track from audio.
+    For best results, use isolated vocals (not full mix).
+    """
+    try:
+        print(f"   [DEBUG] Processing: {file_path}")
+        cache_path = _pitch_cache_path(file_path, sr)
+        midi_q = _read_pitch_cache(cache_path)
+        if midi_q is not None:
+            # int8 quarter-semitones on disk; decode to semitones
+            midi = midi_q.astype(np.float32) / PITCH_QUANT_STEPS
+            print(f"   [CACHE] Loaded {len(midi)} MIDI frames")
+            return midi
+
+        # 1. Load audio
+        y = _load_audio(file_path, sr)
         
-        # 3. Keep ONLY voiced frames (remove NaNs)
-        valid_mask = ~np.isnan(f0)
-        f0_clean = f0[valid_mask]
-        
-        if len(f0_clean) < 15:
-            print(f"   [WARN] Melody too short ({len(f0_clean)} frames)")
+        # 2-7. Pitch track -> clean MIDI contour
+        midi = extract_contour(y, sr)
+        if midi is None:
             return None
         
-        # 4. Median filter (removes jitter + vibrato)
-        kernel_size = min(5, len(f0_clean) if len(f0_clean) % 2 == 1 else len(f0_clean) - 1)
-        if kernel_size >= 3:
-            f0_clean = medfilt(f0_clean, kernel_size=kernel_size)
-        
-        # 5. Convert to MIDI
-        midi = librosa.hz_to_midi(f0_clean)
-        
-        # 6. Remove outliers (octave errors)
-        p5 = np.percentile(midi, 5)
-        p95 = np.percentile(midi, 95)
-        midi = np.clip(midi, p5, p95)
-        
-        # 7. Zero-center
-        midi = midi - np.mean(midi)
+        # 8. Quantize for the cache; return the same values on hit and miss
+        midi_q = np.clip(np.round(midi * PITCH_QUANT_STEPS), -127, 127).astype(np.int8)
+        _write_pitch_cache(cache_path, midi_q)
+        midi = midi_q.astype(np.float32) / PITCH_QUANT_STEPS
         
         print(f"   [OK] Extracted {len(midi)} MIDI frames")
         return midi
@@ -77,7 +316,7 @@ def normalize_to_intervals(pitch_midi):
     Output: [+2, +2, +1, -1]       (intervals)
     """
     if len(pitch_midi) < 2:
-        return np.array([])
+        return np.array([], dtype=np.int8)
     
     # Compute intervals (differences)
     intervals = np.diff(pitch_midi)
@@ -88,22 +327,38 @@ def normalize_to_intervals(pitch_midi):
     # Clip extreme jumps (likely errors)
     intervals = np.clip(intervals, -7, 7)
     
-    return intervals
+    # Whole semitones in [-7, 7] fit in int8: 4-8x less memory for DTW
+    return intervals.astype(np.int8)
+
 
+def _dtw_input(seq):
+    """int8 interval sequences go to the kernel as-is; anything else as float32."""
+    seq = np.asarray(seq)
+    if seq.dtype == np.int8:
+        return seq
+    return seq.astype(np.float32, copy=False)
 
-def compute_dtw_distance(seq1, seq2):
+
+def compute_dtw_distance(seq1, seq2, max_dist=np.inf):
     """
     DTW with L1 distance, normalized by path length.
+    If the normalized distance is sure to exceed max_dist (e.g. the best
+    match so far), returns (inf, 0) without finishing the DP.
     """
-    from fastdtw import fastdtw
-    
-    seq1_2d = seq1.reshape(-1, 1)
-    seq2_2d = seq2.reshape(-1, 1)
+    seq1 = _dtw_input(seq1)
+    seq2 = _dtw_input(seq2)
     
-    # L1 distance
-    distance, path = fastdtw(seq1_2d, seq2_2d, dist=lambda a, b: abs(a - b))
+    # Sakoe-Chiba band: 10% of the longer sequence (at least 10 frames).
+    # It must also cover the length difference or the end is unreachable.
+    n, m = len(seq1), len(seq2)
+    radius = max(10, int(0.1 * max(n, m)), abs(n - m))
+    # A path has at most n + m - 1 cells, so cost > max_dist * (n + m)
+    # already guarantees a normalized distance > max_dist
+    distance, path_len = banded_dtw(seq1, seq2, radius, max_dist * (n + m))
+    if not np.isfinite(distance):
+        return np.inf, 0
     
     # Normalize by path length
-    normalized = distance / (len(path) + 1)
+    normalized = float(distance) / (path_len + 1)
     
-    return normalized, len(path)
+    return normalized, int(path_len)
@@ -1,4 +1,5 @@
 
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
@@ -7,11 +8,19 @@ from pathlib import Path
 
 from backend.routes.humming import router as humming_router
 from backend.config import MEDIA_ROOT, RAW_DATA_DIR
+from backend.services import matcher
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Load the song database before the first request instead of during it
+    matcher.get_song_database()
+    yield
 
 app = FastAPI(
     title="Humming Search Backend (QTune Port)",
     description="FastAPI port of the Django Humming Search backend.",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS Middleware
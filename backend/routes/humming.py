@@ -3,17 +3,61 @@ from fastapi import APIRouter, File, UploadFile, HTTPException, Request, Depends
 from fastapi.responses import JSONResponse, FileResponse
 from typing import Optional, List
 import os
-import shutil
 import tempfile
 import asyncio
+import hashlib
+from collections import OrderedDict
 from pathlib import Path
 
+import numpy as np
+
 from backend.config import MEDIA_ROOT
 from backend.services import pitch, melody, matcher, dtw
 from backend.schemas import SearchResponse, ExtractedFeatures, Match, SongInfo
 
 router = APIRouter()
 
+MEDIA_TYPES = {
+    ".mp3": "audio/mpeg",
+    ".wav": "audio/wav",
+    ".ogg": "audio/ogg",
+    ".m4a": "audio/mp4",
+    ".flac": "audio/flac",
+}
+
+# Features of recent queries keyed by a digest of the raw audio bytes,
+# so a retried upload/recording skips decoding and pitch extraction
+FEATURE_CACHE_SIZE = 128
+_feature_cache = OrderedDict()
+
+def _get_cached_features(key: str):
+    features = _feature_cache.get(key)
+    if features is not None:
+        _feature_cache.move_to_end(key)
+    return features
+
+def _cache_features(key: str, features: dict):
+    _feature_cache[key] = features
+    _feature_cache.move_to_end(key)
+    if len(_feature_cache) > FEATURE_CACHE_SIZE:
+        _feature_cache.popitem(last=False)
+
+def _features_response(features: dict) -> dict:
+    """Features as plain JSON types (relative_pitches is an int8 array)."""
+    return {**features, 'relative_pitches': np.asarray(features['relative_pitches']).tolist()}
+
+def _save_upload(src, file_path: Path) -> str:
+    """
+    Copy an uploaded file to disk (blocking; run in a worker thread).
+    Returns a digest of its contents for the feature cache.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "wb") as buffer:
+        while chunk := src.read(1 << 20):
+            digest.update(chunk)
+            buffer.write(chunk)
+    return digest.hexdigest()
+
 @router.post("/upload", response_model=SearchResponse)
 async def upload_audio(audio: UploadFile = File(...)):
     """Handle audio file upload and perform search."""
@@ -24,22 +68,26 @@ async def upload_audio(audio: UploadFile = File(...)):
         
         file_path = uploads_dir / audio.filename
         
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(audio.file, buffer)
-            
-        # Process the audio
-        # load_audio logic from pitch service
-        # But load_audio expects path
-        audio_data, sr = pitch.load_audio(str(file_path))
+        # Write off the event loop so other requests keep being served
+        key = await asyncio.to_thread(_save_upload, audio.file, file_path)
+        features = _get_cached_features(key)
         
-        if audio_data is None:
-             return SearchResponse(success=False, error="Could not load or analyze audio file.")
+        if features is None:
+            # Process the audio
+            # load_audio logic from pitch service
+            # But load_audio expects path
+            audio_data, sr = pitch.load_audio(str(file_path))
+            
+            if audio_data is None:
+                 return SearchResponse(success=False, error="Could not load or analyze audio file.")
 
-        features = melody.extract_features(audio_data)
+            features = melody.extract_features(audio_data)
+            if features:
+                _cache_features(key, features)
         
         if features:
             # Find matches
-            database = matcher.load_song_database()
+            database = matcher.get_song_database()
             
             if not database:
                  return SearchResponse(success=False, error="No songs in database. Please add songs first.")
@@ -64,7 +112,7 @@ async def upload_audio(audio: UploadFile = File(...)):
             
             return SearchResponse(
                 success=True,
-                features=features,
+                features=_features_response(features),
                 matches=match_objects
             )
         else:
@@ -98,28 +146,33 @@ async def record_audio(
         if not audio_data:
              return SearchResponse(success=False, error="No audio data received")
         
-        # Check for WebM/Opus signature (from original code)
-        if isinstance(audio_data, bytes):
-             # Original check: if audio_data[:4] == b'\x1aE\xdf\xa3' or b'webm' in audio_data[:100].lower():
-             if audio_data[:4] == b'\x1aE\xdf\xa3' or b'webm' in audio_data[:100].lower():
-                 print("Converting WebM to WAV...")
-                 wav_data = pitch.convert_webm_to_wav(audio_data)
-                 if wav_data:
-                     audio_data = wav_data
-                 else:
-                     return SearchResponse(success=False, error="Failed to convert audio format. Install ffmpeg.")
+        # Same recording as a recent request: skip conversion and extraction
+        key = hashlib.blake2b(audio_data, digest_size=16).hexdigest()
+        features = _get_cached_features(key)
         
-        # Process audio from bytes
-        # pitch.load_audio_from_bytes
-        audio_array, sr = pitch.load_audio_from_bytes(audio_data)
-        
-        if audio_array is None:
-             return SearchResponse(success=False, error="Could not load audio data.")
-             
-        features = melody.extract_features(audio_array)
+        if features is None:
+            # Check for WebM/Opus signature (from original code)
+            # Original check: if audio_data[:4] == b'\x1aE\xdf\xa3' or b'webm' in audio_data[:100].lower():
+            if audio_data[:4] == b'\x1aE\xdf\xa3' or b'webm' in audio_data[:100].lower():
+                print("Decoding WebM...")
+                # ffmpeg hands back float32 samples at SAMPLE_RATE directly
+                audio_array, sr = await asyncio.to_thread(pitch.decode_webm, audio_data)
+                if audio_array is None:
+                    return SearchResponse(success=False, error="Failed to convert audio format. Install ffmpeg.")
+            else:
+                # Process audio from bytes
+                # pitch.load_audio_from_bytes
+                audio_array, sr = pitch.load_audio_from_bytes(audio_data)
+            
+            if audio_array is None:
+                 return SearchResponse(success=False, error="Could not load audio data.")
+                 
+            features = melody.extract_features(audio_array)
+            if features:
+                _cache_features(key, features)
         
         if features:
-             database = matcher.load_song_database()
+             database = matcher.get_song_database()
              if not database:
                   return SearchResponse(success=False, error="No songs in database.")
              
@@ -140,7 +193,7 @@ async def record_audio(
                 ) for m in matches
             ]
             
-             return SearchResponse(success=True, features=features, matches=match_objects)
+             return SearchResponse(success=True, features=_features_response(features), matches=match_objects)
         else:
              return SearchResponse(success=False, error="Could not extract features.")
              
@@ -154,7 +207,7 @@ async def record_audio(
 async def match_song(features: ExtractedFeatures):
     """Match pre-extracted features against database."""
     try:
-        database = matcher.load_song_database()
+        database = matcher.get_song_database()
         
         # Convert Pydantic to dict for matcher
         user_features_dict = features.dict()
@@ -184,7 +237,7 @@ async def match_song(features: ExtractedFeatures):
 @router.get("/get_songs")
 async def get_songs():
     """Get list of available songs."""
-    database = matcher.load_song_database()
+    database = matcher.get_song_database()
     songs = []
     for song in database:
         songs.append({
@@ -200,11 +253,15 @@ async def get_songs():
 async def play_song(song_path: str):
     """Serve song file for playback."""
     full_path = MEDIA_ROOT / song_path
-    if full_path.exists():
-        media_type = "audio/mpeg"
-        if full_path.suffix == ".wav": media_type = "audio/wav"
-        elif full_path.suffix == ".ogg": media_type = "audio/ogg"
-        
-        return FileResponse(full_path, media_type=media_type)
-    else:
+    try:
+        # One stat() serves both the existence check and FileResponse
+        stat_result = full_path.stat()
+    except OSError:
         return JSONResponse({"error": "Song not found"}, status_code=404)
+    
+    return FileResponse(
+        full_path,
+        media_type=MEDIA_TYPES.get(full_path.suffix.lower(), "audio/mpeg"),
+        stat_result=stat_result,
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
@@ -0,0 +1,68 @@
+"""
+Numba DTW kernel shared by the matcher (dtw.calculate_similarity) and
+dsp_utils.compute_dtw_distance. Releases the GIL, so songs can be
+scored on several threads at once.
+"""
+
+import numba
+import numpy as np
+
+
+# No fastmath: the kernel relies on inf sentinels, which fastmath's
+# no-inf assumption would let LLVM optimise away
+@numba.njit(cache=True, nogil=True)
+def banded_dtw(a, b, radius, max_cost=np.inf):
+    """
+    Sakoe-Chiba banded DTW with L1 cost.
+    Keeps two rolling rows; returns (total cost, path length).
+    Abandons early with (inf, 0) once every cell in a row exceeds max_cost,
+    since costs only grow along a warping path.
+    Returns (inf, 0) when the band can't reach the end cell.
+    """
+    n, m = a.shape[0], b.shape[0]
+    inf = np.inf
+    if abs(n - m) > radius:
+        return np.float32(inf), np.int32(0)
+
+    prev = np.full(m + 1, inf, dtype=np.float32)
+    curr = np.full(m + 1, inf, dtype=np.float32)
+    prev_len = np.zeros(m + 1, dtype=np.int32)
+    curr_len = np.zeros(m + 1, dtype=np.int32)
+    prev[0] = 0.0
+
+    for i in range(1, n + 1):
+        j_lo = max(1, i - radius)
+        j_hi = min(m, i + radius)
+        # Cells just outside the band must read as unreachable next row
+        curr[j_lo - 1] = inf
+        if j_hi < m:
+            curr[j_hi + 1] = inf
+
+        row_min = inf
+        for j in range(j_lo, j_hi + 1):
+            best = prev[j - 1]
+            best_len = prev_len[j - 1]
+            if prev[j] < best:
+                best = prev[j]
+                best_len = prev_len[j]
+            if curr[j - 1] < best:
+                best = curr[j - 1]
+                best_len = curr_len[j - 1]
+            curr[j] = abs(np.float32(a[i - 1]) - np.float32(b[j - 1])) + best
+            curr_len[j] = best_len + 1
+            if curr[j] < row_min:
+                row_min = curr[j]
+
+        if row_min > max_cost:
+            return np.float32(inf), np.int32(0)
+
+        prev, curr = curr, prev
+        prev_len, curr_len = curr_len, prev_len
+
+    return prev[m], prev_len[m]
+
+
+# Compile at import (or load from numba's on-disk cache) for the input
+# types used by the callers, so the first request doesn't pay for the JIT
+for _dtype in (np.float32, np.int8):
+    banded_dtw(np.zeros(2, dtype=_dtype), np.zeros(2, dtype=_dtype), 1, np.inf)
@@ -8,7 +8,7 @@ from pathlib import Path
 sys.path.append(os.getcwd())
 
 from backend.config import RAW_DATA_DIR, SONG_DATABASE_PATH, BASE_DIR
-from backend.services import pitch, melody
+from backend.services import indexing, matcher
 
 def add_new_songs():
     """
@@ -49,9 +49,10 @@ def add_new_songs():
         return
 
     new_songs_added = 0
+    pending = []
     
     # Sort folders for consistent processing order
-    song_folders = sorted([f for f in RAW_DATA_DIR.iterdir() if f.is_dir()])
+    song_folders = sorted(Path(e.path) for e in os.scandir(RAW_DATA_DIR) if e.is_dir())
     
     for folder in song_folders:
         song_id = folder.name # Use folder name as default ID
@@ -64,9 +65,13 @@ def add_new_songs():
             
         print(f"\nProcessing new song: {song_id}")
         
+        # One directory listing per folder; every lookup below uses it
+        # instead of its own exists()/iterdir() call
+        entries = {e.name: e for e in os.scandir(folder) if e.is_file()}
+        
         # 3. Read Metadata
         info_path = folder / "info.json"
-        if not info_path.exists():
+        if "info.json" not in entries:
             print(f"  Skipping: No info.json found in {folder.name}")
             continue
             
@@ -80,49 +85,38 @@ def add_new_songs():
         # Read optional text files
         lyrics = ""
         lyrics_path = folder / "lyrics.txt"
-        if lyrics_path.exists():
+        if "lyrics.txt" in entries:
             with open(lyrics_path, 'r', encoding='utf-8') as f:
                 lyrics = f.read()
                 
         credits_text = ""
         credits_path = folder / "credits.txt"
-        if credits_path.exists():
+        if "credits.txt" in entries:
             with open(credits_path, 'r', encoding='utf-8') as f:
                 credits_text = f.read()
                 
         bio = ""
         bio_path = folder / "about.txt"
-        if bio_path.exists():
+        if "about.txt" in entries:
             with open(bio_path, 'r', encoding='utf-8') as f:
                 bio = f.read()
 
         # Locate Audio
-        audio_file = None
-        for f in folder.iterdir():
-             if f.suffix.lower() in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']:
-                 audio_file = f
-                 break
+        audio_file = indexing.find_audio_file(folder, entries)
         
         if not audio_file:
             print(f"  Skipping: No audio file found in {folder.name}")
             continue
 
-        # 4. Extract Features (Backend)
-        print(f"  Extracting features from {audio_file.name}...")
-        try:
-            audio, sr = pitch.load_audio(str(audio_file))
-            if audio is None:
-                print("    Failed to load audio.")
-                continue
-                
-            features = melody.extract_features(audio)
-            
-            if not features or not features.get('relative_pitches'):
-                print("    Failed to extract features.")
-                continue
-                
-        except Exception as e:
-            print(f"    Error processing audio: {e}")
+        pending.append((folder, entries, song_id, info, lyrics, credits_text, bio, audio_file))
+
+    # 4. Extract Features (Backend)
+    # Songs are independent, so extract them in parallel; merging into the
+    # databases below stays on this thread, in folder order
+    all_features = indexing.extract_features_parallel([task[-1] for task in pending])
+
+    for (folder, entries, song_id, info, lyrics, credits_text, bio, audio_file), features in zip(pending, all_features):
+        if not features:
             continue
 
         # 5. Construct Objects
@@ -153,11 +147,11 @@ def add_new_songs():
         # Images
         cover_image = info.get('cover_image')
         # specific check for files
-        if (folder / "cover.jpg").exists():
+        if "cover.jpg" in entries:
             cover_image = f"/data/raw_data/{song_id}/cover.jpg"
         
         artist_image = info.get('artist_image')
-        if (folder / "artist.jpg").exists():
+        if "artist.jpg" in entries:
             artist_image = f"/data/raw_data/{song_id}/artist.jpg"
 
         # Frontend Object
@@ -216,8 +210,7 @@ def add_new_songs():
             json.dump(frontend_db, f, indent=2)
         print(f"Updated {frontend_songs_path}")
             
-        with open(SONG_DATABASE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(backend_db, f, indent=2)
+        matcher.save_song_database(backend_db, SONG_DATABASE_PATH)
         print(f"Updated {SONG_DATABASE_PATH}")
         
     else:
@@ -9,7 +9,54 @@ from pathlib import Path
 sys.path.append(os.getcwd())
 
 from backend.config import RAW_DATA_DIR, SONG_DATABASE_PATH, BASE_DIR
-from backend.services import pitch, melody
+from backend.services import indexing, matcher
+
+def _find_song_audio(song: dict):
+    """Audio file for a songs.json entry (raw_data/{id}/...), or None."""
+    song_id = song.get('id')
+    title = song.get('title')
+    
+    # Look for audio file in raw_data/{id}/audio.mp3 (or other formats)
+    song_folder = RAW_DATA_DIR / song_id
+    
+    if not song_folder.exists():
+        print(f"  Warning: Folder does not exist for '{title}' (ID: {song_id})")
+        return None
+    
+    # Prioritize audio.mp3 (one stat, no listing), then scan
+    if os.path.isfile(song_folder / "audio.mp3"):
+        return song_folder / "audio.mp3"
+    
+    audio_file = indexing.find_audio_file(song_folder)
+    if not audio_file:
+        print(f"  Warning: No audio file found for '{title}' in {song_folder}")
+    return audio_file
+
+def _database_entry(song: dict, audio_file: Path, features: dict) -> dict:
+    """Database entry for a songs.json entry and its extracted features."""
+    song_id = song.get('id')
+    title = song.get('title')
+    # Build database entry
+    # Include ID and metadata from songs.json to link them
+    return {
+        'id': song_id,
+        'title': title, # Use title from json
+        'artist': song.get('artist'),
+        'name': title, # For compatibility with matcher.py which uses 'name'
+        # Store path relative to RAW_DATA_DIR parent (data/raw_data/...)
+        # or just use the ID to find it? Matcher uses path for logging.
+        # Frontend uses /data/raw_data/...
+        'path': f"data/raw_data/{song_id}/{audio_file.name}", 
+        'tempo': features['tempo'],
+        'relative_pitches': features['relative_pitches'],
+        'pitch_count': features['pitch_count'],
+        'duration': features['duration'],
+        'onset_count': features.get('onset_count', 0),
+        # Copy other metadata just in case backend needs it later
+        'cover_image': song.get('cover_image'),
+        'artist_image': song.get('artist_image'),
+        'theme_color': song.get('theme_color')
+    }
 
 def build_database():
     """Build song database from frontend/src/data/songs.json and raw_data."""
@@ -36,80 +83,22 @@ def build_database():
     print(f"Processing {len(songs_metadata)} songs...")
     print(f"Reading audio from: {RAW_DATA_DIR}")
 
+    pending = []
     for song in songs_metadata:
-        song_id = song.get('id')
-        title = song.get('title')
-        
-        # Look for audio file in raw_data/{id}/audio.mp3 (or other formats)
-        song_folder = RAW_DATA_DIR / song_id
-        
-        if not song_folder.exists():
-            print(f"  Warning: Folder does not exist for '{title}' (ID: {song_id})")
-            continue
-            
-        audio_file = None
-        # Prioritize audio.mp3, then check others
-        if (song_folder / "audio.mp3").exists():
-            audio_file = song_folder / "audio.mp3"
-        else:
-             # Scan
-             for f in song_folder.iterdir():
-                 if f.suffix.lower() in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']:
-                     audio_file = f
-                     break
-        
-        if not audio_file:
-            print(f"  Warning: No audio file found for '{title}' in {song_folder}")
-            continue
-            
-        print(f"  Processing '{title}' ({audio_file.name})...")
-        
-        try:
-            # Load audio
-            audio, sr = pitch.load_audio(str(audio_file))
-            
-            if audio is None:
-                print(f"    Failed to load audio.")
-                continue
-                
-            # Extract features
-            features = melody.extract_features(audio)
-            
-            if features and features.get('relative_pitches'):
-                # Build database entry
-                # Include ID and metadata from songs.json to link them
-                entry = {
-                    'id': song_id,
-                    'title': title, # Use title from json
-                    'artist': song.get('artist'),
-                    'name': title, # For compatibility with matcher.py which uses 'name'
-                    # Store path relative to RAW_DATA_DIR parent (data/raw_data/...)
-                    # or just use the ID to find it? Matcher uses path for logging.
-                    # Frontend uses /data/raw_data/...
-                    'path': f"data/raw_data/{song_id}/{audio_file.name}", 
-                    'tempo': features['tempo'],
-                    'relative_pitches': features['relative_pitches'],
-                    'pitch_count': features['pitch_count'],
-                    'duration': features['duration'],
-                    'onset_count': features.get('onset_count', 0),
-                    # Copy other metadata just in case backend needs it later
-                    'cover_image': song.get('cover_image'),
-                    'artist_image': song.get('artist_image'),
-                    'theme_color': song.get('theme_color')
-                }
-                
-                database.append(entry)
-                print(f"    [+] Success. {features['pitch_count']} pitches.")
-            else:
-                print(f"    Failed to extract features.")
-                
-        except Exception as e:
-            print(f"    Error processing: {e}")
+        audio_file = _find_song_audio(song)
+        if audio_file:
+            pending.append((song, audio_file))
+    
+    # Extracted in parallel; results come back in songs.json order
+    all_features = indexing.extract_features_parallel([audio_file for _, audio_file in pending])
+    for (song, audio_file), features in zip(pending, all_features):
+        if features:
+            database.append(_database_entry(song, audio_file, features))
+            print(f"    [+] '{song.get('title')}': {features['pitch_count']} pitches.")
 
     # Save database
     print(f"\nSaving database with {len(database)} songs to {SONG_DATABASE_PATH}...")
-    with open(SONG_DATABASE_PATH, 'w', encoding='utf-8') as f:
-        json.dump(database, f, indent=2)
+    matcher.save_song_database(database, SONG_DATABASE_PATH)
         
     print("Done!")
 
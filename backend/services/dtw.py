@@ -1,37 +1,137 @@
 
 import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+from scipy.signal import fftconvolve
 
-def calculate_similarity(song_features: dict, user_features: dict) -> float:
-    """Calculate similarity score between song and user input."""
+from backend.services._dtw_kernel import banded_dtw
+
+# Warping radius of the LB_Keogh envelopes precomputed per song; this is
+# also the smallest DTW band calculate_similarity uses
+LB_RADIUS = 10
+
+def _pitch_energy(song: np.ndarray) -> np.ndarray:
+    """Prefix sums of squared pitch changes (for sliding window norms)."""
+    return np.concatenate(([0.0], np.cumsum(song.astype(np.float64) ** 2)))
+
+def _envelope(song: np.ndarray, radius: int):
+    """Running max/min of the song over +/- radius (LB_Keogh envelope)."""
+    if len(song) == 0:
+        return song, song
+    size = 2 * radius + 1
+    return (maximum_filter1d(song, size, mode='nearest'),
+            minimum_filter1d(song, size, mode='nearest'))
+
+def prepare_song(song_features: dict):
+    """
+    Precompute the query-independent parts of calculate_similarity for a
+    database entry (float32 pitches, pitch energy, LB_Keogh envelope),
+    once at load time.
+    """
+    song_array = np.asarray(song_features.get('relative_pitches', []), dtype=np.float32)
+    song_features['_pitch_array'] = song_array
+    song_features['_pitch_energy'] = _pitch_energy(song_array)
+    song_features['_pitch_upper'], song_features['_pitch_lower'] = _envelope(song_array, LB_RADIUS)
+
+def _best_offset(song: np.ndarray, user: np.ndarray, energy: np.ndarray = None) -> int:
+    """
+    Start of the song window that best lines up with the user's sequence,
+    by normalized cross-correlation (one FFT over all offsets).
+    """
+    n = len(user)
+    if len(song) <= n:
+        return 0
+    
+    # Dot product of the user sequence with every length-n song window
+    dots = fftconvolve(song, user[::-1], mode='valid')
+    # Sliding window norms from a prefix sum of squares
+    if energy is None:
+        energy = _pitch_energy(song)
+    window_norms = np.sqrt(energy[n:] - energy[:-n])
+    scores = np.divide(dots, window_norms, out=np.zeros_like(dots), where=window_norms > 0)
+    return int(np.argmax(scores))
+
+def _tempo_similarity(song_features: dict, user_features: dict) -> float:
+    song_tempo = song_features.get('tempo', 120)
+    user_tempo = user_features.get('tempo', 120)
+    
+    # detect_bpm gives 0.0 for silent audio, and /match accepts any tempo
+    max_tempo = max(song_tempo, user_tempo)
+    if max_tempo <= 0:
+        return 0.0
+    
+    tempo_diff = abs(song_tempo - user_tempo)
+    return max(0, 1.0 - tempo_diff / max_tempo)
+
+def max_similarity(song_features: dict, user_features: dict) -> float:
+    """Upper bound on calculate_similarity: tempo term plus a perfect pitch match."""
+    if len(song_features.get('relative_pitches', [])) == 0 or len(user_features.get('relative_pitches', [])) == 0:
+        return 0.0
+    return min(100, (0.6 + 0.4 * _tempo_similarity(song_features, user_features)) * 100)
+
+def calculate_similarity(song_features: dict, user_features: dict, min_score: float = 0.0):
+    """
+    Calculate similarity score between song and user input.
+    Returns None instead once the song provably can't reach min_score
+    (via the tempo bound, LB_Keogh, or DTW early abandoning).
+    """
     try:
         song_pitches = song_features.get('relative_pitches', [])
         user_pitches = user_features.get('relative_pitches', [])
         
-        if not song_pitches or not user_pitches:
+        # len() rather than truthiness: pitches may be numpy arrays
+        if len(song_pitches) == 0 or len(user_pitches) == 0:
             return 0.0
         
         # Calculate tempo similarity
-        song_tempo = song_features.get('tempo', 120)
-        user_tempo = user_features.get('tempo', 120)
+        tempo_similarity = _tempo_similarity(song_features, user_features)
         
-        tempo_diff = abs(song_tempo - user_tempo)
-        tempo_similarity = max(0, 1.0 - tempo_diff / max(song_tempo, user_tempo))
+        # Pitch similarity needed to reach min_score; over 1 is impossible
+        needed = (min_score / 100 - 0.4 * tempo_similarity) / 0.6
+        if needed > 1:
+            return None
         
-        # Calculate pitch sequence similarity using correlation (user called this "DTW"?)
+        # Calculate pitch sequence similarity with banded DTW, which
+        # tolerates the hum being sung faster/slower than the song
         if len(song_pitches) > 0 and len(user_pitches) > 0:
-            # Simple correlation-based similarity
             min_len = min(len(song_pitches), len(user_pitches))
-            song_segment = np.array(song_pitches[:min_len])
-            user_segment = np.array(user_pitches[:min_len])
+            song_array = song_features.get('_pitch_array')
+            if song_array is None:
+                song_array = np.asarray(song_pitches, dtype=np.float32)
+            user_segment = np.asarray(user_pitches[:min_len], dtype=np.float32)
+            
+            # Compare against the part of the song the hum most resembles,
+            # not just its opening
+            offset = _best_offset(song_array, user_segment, song_features.get('_pitch_energy'))
+            song_segment = song_array[offset:offset + min_len]
             
-            if np.std(song_segment) > 0 and np.std(user_segment) > 0:
-                pitch_corr = np.corrcoef(song_segment, user_segment)[0, 1]
-                if np.isnan(pitch_corr):
-                    pitch_similarity = 0
+            # Sakoe-Chiba band: 10% of the length, at least 10 steps
+            radius = max(LB_RADIUS, int(0.1 * min_len))
+            
+            max_cost = np.inf
+            if needed > 0:
+                # distance = cost / (path_len + 1) with path_len <= 2 * min_len - 1,
+                # so any cost above this leaves the song under min_score
+                max_cost = (1.0 / needed - 1.0) * 2 * min_len
+                
+                # LB_Keogh: every hum step is matched within +/- radius of its
+                # position, so it costs at least its distance to the envelope
+                upper = song_features.get('_pitch_upper')
+                if upper is not None and radius == LB_RADIUS:
+                    upper = upper[offset:offset + min_len]
+                    lower = song_features['_pitch_lower'][offset:offset + min_len]
                 else:
-                    pitch_similarity = max(0, pitch_corr)
-            else:
-                pitch_similarity = 0.5
+                    upper, lower = _envelope(song_segment, radius)
+                lower_bound = np.maximum(0, np.maximum(user_segment - upper, lower - user_segment)).sum()
+                if lower_bound > max_cost:
+                    return None
+            
+            cost, path_len = banded_dtw(user_segment, song_segment, radius, max_cost)
+            if not np.isfinite(cost):
+                return None
+            
+            # Mean per-step semitone error along the warping path -> (0, 1]
+            distance = float(cost) / (path_len + 1)
+            pitch_similarity = 1.0 / (1.0 + distance)
         else:
             pitch_similarity = 0
         
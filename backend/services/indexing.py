@@ -0,0 +1,56 @@
+"""
+Offline helpers shared by the database scripts (build_database,
+add_songs, matcher.create_song_database): locating a song's audio file
+and extracting features for many songs across a process pool.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from backend.config import AUDIO_EXTENSIONS
+from backend.services import melody
+
+def _log(message: str):
+    """Worker output, prefixed with the PID so parallel songs stay readable."""
+    print(f"[{os.getpid()}] {message}", flush=True)
+
+def find_audio_file(song_folder, names=None) -> Path:
+    """
+    First file in a song folder with a known audio extension, or None.
+    Pass the folder's file names if they were already listed, to skip
+    listing it again.
+    """
+    song_folder = Path(song_folder)
+    if names is None:
+        try:
+            with os.scandir(song_folder) as entries:
+                names = [e.name for e in entries if e.is_file()]
+        except OSError:
+            return None
+    return next((song_folder / name for name in names
+                 if os.path.splitext(name)[1].lower() in AUDIO_EXTENSIONS), None)
+
+def _extract_one(audio_file: Path):
+    """Features for one audio file, or None if extraction failed.
+
+    Runs in a worker process, so it must stay a top-level function.
+    """
+    _log(f"  Extracting features from {audio_file}...")
+    try:
+        features = melody.extract_features_from_file(audio_file)
+        if features and features.get('pitch_count'):
+            return features
+        _log(f"    Failed to extract features from {audio_file}")
+    except Exception as e:
+        _log(f"    Error processing {audio_file}: {e}")
+    return None
+
+def extract_features_parallel(audio_files: list) -> list:
+    """
+    Features for each audio file (None where extraction failed), in input
+    order. Songs are independent, so they are spread across cores.
+    """
+    if not audio_files:
+        return []
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        return list(executor.map(_extract_one, audio_files))
@@ -1,27 +1,144 @@
 
+import heapq
 import json
 import os
+import tempfile
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from backend.config import RAW_DATA_DIR, SONG_DATABASE_PATH, MEDIA_ROOT
-from backend.services import melody, dtw
+from backend.services import dtw, indexing
+
+try:
+    import orjson  # Much faster (de)serialization of the song database
+except ImportError:
+    orjson = None
+
+def _dumps(obj) -> bytes:
+    """JSON-encode one database entry (int8 pitch arrays become lists)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, default=lambda o: o.tolist()).encode('utf-8')
+
+def _stored_fields(song: dict) -> dict:
+    """Entry without the '_'-prefixed values computed at load time."""
+    return {k: v for k, v in song.items() if not k.startswith('_')}
+
+def _loads(data: bytes):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _pack_path(db_path: Path) -> Path:
+    """Packed (.npz) copy of a JSON song database, written alongside it."""
+    return Path(db_path).with_suffix('.npz')
+
+def _save_pack(database: list, pack_path: Path):
+    """
+    Write the database as one int8 array of all relative pitches plus
+    per-song offsets, with the remaining fields as a JSON string.
+    Loading it skips parsing thousands of pitch ints from JSON.
+    """
+    pitch_arrays = [np.asarray(song['relative_pitches'], dtype=np.int8) for song in database]
+    offsets = np.zeros(len(database) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(p) for p in pitch_arrays])
+    meta = [{k: v for k, v in _stored_fields(song).items() if k != 'relative_pitches'}
+            for song in database]
+    
+    # Write then rename, so a reader never sees a half-written pack.
+    # The temp name is unique: several workers may load the JSON at once.
+    fd, tmp_path = tempfile.mkstemp(dir=pack_path.parent, suffix='.tmp.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(
+                f,
+                pitches=np.concatenate(pitch_arrays) if pitch_arrays else np.zeros(0, dtype=np.int8),
+                offsets=offsets,
+                meta=np.array(json.dumps(meta))
+            )
+        os.replace(tmp_path, pack_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _load_pack(pack_path: Path) -> list:
+    """Rebuild database entries from a pack; pitches are int8 array views."""
+    with np.load(pack_path) as pack:
+        pitches = pack['pitches']
+        offsets = pack['offsets']
+        database = json.loads(str(pack['meta']))
+    for i, song in enumerate(database):
+        song['relative_pitches'] = pitches[offsets[i]:offsets[i + 1]]
+        dtw.prepare_song(song)
+    return database
+
+def save_song_database(database: list, db_path: Path = None):
+    """Write the song database as JSON plus its packed .npz copy."""
+    db_path = Path(db_path or SONG_DATABASE_PATH)
+    with open(db_path, 'wb') as f:
+        # One entry per line, written as we go: no whole-database string
+        # in memory and no pretty-printer pass
+        f.write(b'[\n')
+        for i, song in enumerate(database):
+            if i:
+                f.write(b',\n')
+            f.write(_dumps(_stored_fields(song)))
+        f.write(b'\n]\n')
+    _save_pack(database, _pack_path(db_path))
 
 def load_song_database() -> list:
-    """Load song database from JSON file."""
+    """Load song database (packed copy if it is up to date, else JSON)."""
     if not os.path.exists(SONG_DATABASE_PATH):
         # Create initial database
         return create_song_database()
     
     else:
+        pack_path = _pack_path(SONG_DATABASE_PATH)
+        try:
+            if pack_path.stat().st_mtime_ns >= os.stat(SONG_DATABASE_PATH).st_mtime_ns:
+                return _load_pack(pack_path)
+        except Exception:
+            pass # Missing or unreadable pack: fall back to JSON
+        
         # Load existing database
         try:
-            with open(SONG_DATABASE_PATH, 'r') as f:
-                database = json.load(f)
+            with open(SONG_DATABASE_PATH, 'rb') as f:
+                database = _loads(f.read())
                 # Ensure database is a list
                 if not isinstance(database, list):
                     return create_song_database()
-                return database
         except:
             return create_song_database()
+        
+        for song in database:
+            song['relative_pitches'] = np.asarray(song.get('relative_pitches', []), dtype=np.int8)
+            dtw.prepare_song(song)
+        
+        # Refresh the pack so the next start can skip JSON parsing
+        try:
+            _save_pack(database, pack_path)
+        except Exception as e:
+            print(f"Could not write {pack_path}: {e}")
+        return database
+
+_DB_CACHE = {'mtime': None, 'data': None}
+
+def _database_mtime():
+    try:
+        return os.stat(SONG_DATABASE_PATH).st_mtime_ns
+    except OSError:
+        return None
+
+def get_song_database() -> list:
+    """
+    Song database shared by all requests. Loaded once, and again only
+    when songs_database.json changes on disk (e.g. after add_songs runs).
+    """
+    if _DB_CACHE['data'] is None or _DB_CACHE['mtime'] != _database_mtime():
+        data = load_song_database()
+        # Stat after loading: a missing database is created by the load
+        _DB_CACHE.update(mtime=_database_mtime(), data=data)
+    return _DB_CACHE['data']
 
 def create_song_database() -> list:
     """Create song database by scanning songs directory."""
@@ -35,104 +152,150 @@ def create_song_database() -> list:
     
     print(f"Scanning for songs in: {songs_dir}")
     
+    audio_files = []
     if songs_dir.exists():
         # Iterate over subdirectories (each represents a song)
-        for song_folder in songs_dir.iterdir():
-            if song_folder.is_dir():
-                # Look for audio file in folder
-                # Common formats: .mp3, .wav, .m4a
-                audio_file = None
-                for file in song_folder.iterdir():
-                    if file.suffix.lower() in ['.mp3', '.wav', '.ogg', '.m4a', '.flac']:
-                        audio_file = file
-                        break
-                
-                if audio_file:
-                    print(f"Processing {song_folder.name}...")
-                    
-                    try:
-                        from backend.services import pitch
-                        audio, sr = pitch.load_audio(str(audio_file))
-                        
-                        if audio is None:
-                             print(f"  ✗ Could not load audio from {audio_file.name}")
-                             continue
-
-                        features = melody.extract_features(audio)
-                        
-                        if features and features.get('relative_pitches'):
-                            # Use folder name as song name, replacing underscores
-                            song_name = song_folder.name.replace('_', ' ').title()
-                            
-                            # Path stored as relative to RAW_DATA_DIR or absolute?
-                            # Frontend needs to play it.
-                            # If we store absolute path, frontend can't access it unless we mount raw_data.
-                            # We should probably mount RAW_DATA_DIR in main.py as well.
-                            # Or correct the path to be relative to what is mounted.
-                            # For now, store relative to RAW_DATA_DIR.
-                            
-                            database.append({
-                                'name': song_name,
-                                'path': str(audio_file.relative_to(songs_dir.parent)), # data/raw_data/...
-                                'tempo': features['tempo'],
-                                'relative_pitches': features['relative_pitches'],
-                                'pitch_count': features['pitch_count'],
-                                'duration': features['duration'],
-                                'onset_count': features.get('onset_count', 0)
-                            })
-                            print(f"  ✓ Added {song_name} to database")
-                        else:
-                            print(f"  ✗ Could not extract features from {song_name}")
-                    
-                    except Exception as e:
-                        print(f"  ✗ Error processing {song_name}: {e}")
+        with os.scandir(songs_dir) as song_folders:
+            for song_folder in song_folders:
+                if song_folder.is_dir():
+                    audio_file = indexing.find_audio_file(song_folder.path)
+                    if audio_file:
+                        audio_files.append(audio_file)
+    
+    for audio_file, features in zip(audio_files, indexing.extract_features_parallel(audio_files)):
+        # Use folder name as song name, replacing underscores
+        song_name = audio_file.parent.name.replace('_', ' ').title()
+        if not features:
+            print(f"  ✗ Could not extract features from {song_name}")
+            continue
+        
+        # Path stored as relative to RAW_DATA_DIR or absolute?
+        # Frontend needs to play it.
+        # If we store absolute path, frontend can't access it unless we mount raw_data.
+        # We should probably mount RAW_DATA_DIR in main.py as well.
+        # Or correct the path to be relative to what is mounted.
+        # For now, store relative to RAW_DATA_DIR.
+        
+        print(f"  ✓ Added {song_name} to database")
+        database.append({
+            'name': song_name,
+            'path': str(audio_file.relative_to(RAW_DATA_DIR.parent)), # data/raw_data/...
+            'tempo': features['tempo'],
+            'relative_pitches': features['relative_pitches'],
+            'pitch_count': features['pitch_count'],
+            'duration': features['duration'],
+            'onset_count': features.get('onset_count', 0)
+        })
     
     # Save database
-    with open(SONG_DATABASE_PATH, 'w') as f:
-        json.dump(database, f, indent=2)
+    save_song_database(database)
     
     print(f"Database created with {len(database)} songs")
     return database
 
-def find_best_matches(user_features: dict, database: list, top_n: int = 5) -> list:
-    """Find best matching songs from database."""
-    matches = []
+# Below this many songs, thread hand-off costs more than it saves
+PARALLEL_MIN_SONGS = 256
+_scoring_pool = None
+
+# Scores are reported to one decimal; songs pruned more than this below the
+# current top_n cut-off can't tie with it after rounding
+SCORE_MARGIN = 0.1
+
+def _score_songs(songs: list, user_features: dict, top_n: int) -> list:
+    """
+    Similarity of each song, in `songs` order. Songs that provably can't
+    make the top_n get None: the most promising songs (by tempo bound) are
+    scored first, and the running top_n cut-off prunes the rest.
+    """
+    scores = [None] * len(songs)
+    best = []  # min-heap of the top_n scores so far
+    bounds = [dtw.max_similarity(song, user_features) for song in songs]
     
-    # Calculate similarity for all songs
-    for song in database:
-        similarity = dtw.calculate_similarity(song, user_features)
+    for i in sorted(range(len(songs)), key=lambda i: -bounds[i]):
+        cutoff = best[0] - SCORE_MARGIN if len(best) >= top_n else 0.0
+        if bounds[i] < cutoff:
+            break # Sorted by bound: nothing after this can make it either
         
-        matches.append({
-            'id': song.get('id', ''),  # specific ID for frontend
-            'name': song.get('name', 'Unknown'),
-            'title': song.get('title', song.get('name', 'Unknown')),
-            'artist': song.get('artist', 'Unknown Artist'),
-            'cover_image': song.get('cover_image'),
-            'theme_color': song.get('theme_color'),
-            'path': song.get('path', ''),
-            'similarity': round(similarity, 1),
-            'tempo': song.get('tempo', 0),
-            'pitch_count': song.get('pitch_count', 0)
-        })
+        score = dtw.calculate_similarity(songs[i], user_features, min_score=cutoff)
+        if score is None:
+            continue
+        scores[i] = score
+        if len(best) < top_n:
+            heapq.heappush(best, score)
+        else:
+            heapq.heappushpop(best, score)
+    return scores
+
+def _score_database(user_features: dict, database: list, top_n: int) -> list:
+    """
+    Similarity of every song to the query, in database order (None for
+    songs pruned as unable to make the top_n).
+    Large databases are split across threads: the DTW kernel and numpy's
+    FFT/array work release the GIL, and threads share the loaded database
+    where a process pool would have to pickle it.
+    """
+    global _scoring_pool
+    workers = os.cpu_count() or 1
+    if workers == 1 or len(database) < PARALLEL_MIN_SONGS:
+        return _score_songs(database, user_features, top_n)
+    
+    if _scoring_pool is None:
+        _scoring_pool = ThreadPoolExecutor(max_workers=workers)
+    
+    # A few chunks per thread keeps the load even without per-song tasks
+    chunk_size = -(-len(database) // (workers * 4))
+    chunks = [database[i:i + chunk_size] for i in range(0, len(database), chunk_size)]
+    scores = []
+    # Each chunk prunes against its own top_n, which is never stricter than
+    # the global one
+    n_chunks = len(chunks)
+    for chunk_scores in _scoring_pool.map(_score_songs, chunks, [user_features] * n_chunks, [top_n] * n_chunks):
+        scores.extend(chunk_scores)
+    return scores
+
+def find_best_matches(user_features: dict, database: list, top_n: int = 5) -> list:
+    """Find best matching songs from database."""
+    # Calculate similarity for all songs.
+    # Result dicts are only built for the top_n songs actually returned.
+    scores = _score_database(user_features, database, top_n)
+    scored = [
+        (round(similarity, 1), song)
+        for similarity, song in zip(scores, database)
+        if similarity is not None
+    ]
     
     # Sort by similarity (descending because higher is better in qtune_processor.py)
-    matches.sort(key=lambda x: x['similarity'], reverse=True)
+    scored.sort(key=lambda x: x[0], reverse=True)
     
-    if matches:
+    if scored:
         print("\n=== MATCH RESULTS ===")
-        best_score = matches[0]['similarity']
-        second_score = matches[1]['similarity'] if len(matches) > 1 else 0.0
+        best_score = scored[0][0]
+        second_score = scored[1][0] if len(scored) > 1 else 0.0
         
         if second_score > 0:
             ratio = best_score / second_score
         else:
             ratio = 999.0
             
-        print(f"TOP1: {matches[0]['name']} (Score: {best_score})")
-        if len(matches) > 1:
-            print(f"TOP2: {matches[1]['name']} (Score: {second_score})")
+        print(f"TOP1: {scored[0][1].get('name', 'Unknown')} (Score: {best_score})")
+        if len(scored) > 1:
+            print(f"TOP2: {scored[1][1].get('name', 'Unknown')} (Score: {second_score})")
             print(f"RATIO: {ratio:.2f}")
         else:
             print(f"RATIO: N/A (Only 1 match)")
-            
-    return matches[:top_n]
+    
+    return [
+        {
+            'id': song.get('id', ''),  # specific ID for frontend
+            'name': song.get('name', 'Unknown'),
+            'title': song.get('title', song.get('name', 'Unknown')),
+            'artist': song.get('artist', 'Unknown Artist'),
+            'cover_image': song.get('cover_image'),
+            'theme_color': song.get('theme_color'),
+            'path': song.get('path', ''),
+            'similarity': similarity,
+            'tempo': song.get('tempo', 0),
+            'pitch_count': song.get('pitch_count', 0)
+        }
+        for similarity, song in scored[:top_n]
+    ]
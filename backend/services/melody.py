@@ -1,35 +1,31 @@
 
+import hashlib
+import json
+import os
+import tempfile
+import numba
 import numpy as np
-import math
-from math import log2
+from pathlib import Path
 from backend.services import pitch
-from backend.config import SAMPLE_RATE
+from backend.config import SAMPLE_RATE, HOP_LENGTH, PITCH_CACHE_DIR
 
-def _get_note_number(pitch_val: float) -> int:
-    """Return the number of the note based on its frequency value."""
-    if pitch_val <= 0:
-        return 0
-    n = 12 * log2(pitch_val/440) + 49
-    if 1 <= n <= 88:
-        return round(n)
-    return 0
+# Bump when extract_features output changes so cached features are recomputed
+FEATURES_VERSION = 1
 
-def _pitches_per_interval(audio_length, pitch_values: list, onsets: list) -> list:
+def _pitches_per_interval(audio_length, pitch_values: np.ndarray, onsets: np.ndarray) -> np.ndarray:
     """Calculate the number of pitches contained between two consecutive onsets."""
-    num_of_pitches = []
     total_frames = len(pitch_values)
     duration = audio_length / SAMPLE_RATE
     
-    for onset_time in onsets:
-        frame_idx = int((onset_time / duration) * total_frames)
-        num_of_pitches.append(frame_idx)
-    
-    num_of_pitches.append(total_frames)
+    # Frame index of each onset (onset times are >= 0, so the astype
+    # truncation matches int()), followed by the total frame count
+    num_of_pitches = np.empty(len(onsets) + 1, dtype=np.intp)
+    num_of_pitches[:-1] = (np.asarray(onsets, dtype=np.float64) / duration) * total_frames
+    num_of_pitches[-1] = total_frames
     return num_of_pitches
 
-def _average_per_interval(pitch_values: list, pitches_per_interval: list, onsets: list) -> list:
+def _average_per_interval(pitch_values: np.ndarray, pitches_per_interval: np.ndarray, onsets: np.ndarray) -> np.ndarray:
     """Calculate the average of pitches contained between two consecutive onsets."""
-    avg_per_interval = []
     # Note: Using len(onsets) - 1 logic from original code?
     # Original: for i in range(len(onsets) - 1):
     # But num_of_pitches has len(onsets) + 1 elements?
@@ -47,51 +43,67 @@ def _average_per_interval(pitch_values: list, pitches_per_interval: list, onsets
     # This seems intentional in original code to ignore the last segment or something?
     # "Preserve ALL signal processing logic exactly."
     
-    for i in range(len(onsets) - 1):
-        start_idx = pitches_per_interval[i]
-        end_idx = pitches_per_interval[i + 1]
-        
-        if end_idx > start_idx:
-            segment = pitch_values[start_idx:end_idx]
-            # pitch_values is np.array, segment is np.array
-            valid_pitches = segment[segment > 0]
-            
-            if len(valid_pitches) > 0:
-                avg_pitch = np.mean(valid_pitches)
-                note_num = _get_note_number(avg_pitch)
-            else:
-                note_num = 0
-        else:
-            note_num = 0
-        
-        avg_per_interval.append(note_num)
+    n_intervals = len(onsets) - 1
+    if n_intervals <= 0:
+        return np.zeros(0, dtype=np.int64)
     
-    return avg_per_interval
-
-def _find_relative_pitch(avg_pitch_values: list) -> list:
-    """Create and return an array of relative pitch changes."""
-    pitch_change = 0
-    result = []
+    pitch_values = np.asarray(pitch_values, dtype=np.float64)
+    # Clip like slicing does, so out-of-range bounds give empty segments
+    bounds = np.clip(np.asarray(pitches_per_interval[:n_intervals + 1], dtype=np.intp),
+                     0, len(pitch_values))
+    starts, ends = bounds[:-1], bounds[1:]
     
-    for i in range(len(avg_pitch_values) - 1):
-        pitch_change = -1 * (avg_pitch_values[i] - avg_pitch_values[i + 1])
-        if pitch_change == 0 or abs(pitch_change) >= 22:
-            continue
-        result.append(pitch_change)
+    # Segment sums/counts of voiced frames from prefix sums (unlike
+    # np.add.reduceat, empty segments come out as 0)
+    voiced = pitch_values > 0
+    sum_prefix = np.concatenate(([0.0], np.cumsum(np.where(voiced, pitch_values, 0.0))))
+    count_prefix = np.concatenate(([0], np.cumsum(voiced)))
+    sums = sum_prefix[ends] - sum_prefix[starts]
+    counts = count_prefix[ends] - count_prefix[starts]
+    has_pitch = (ends > starts) & (counts > 0)
     
-    return result
+    # Note number (1-88, 0 for silence/out of range) of each segment mean
+    avg_pitch = np.where(has_pitch, sums / np.maximum(counts, 1), 440.0)
+    n = 12 * np.log2(avg_pitch / 440) + 49
+    in_range = has_pitch & (n >= 1) & (n <= 88)
+    return np.where(in_range, np.round(n), 0).astype(np.int64)
+
+@numba.njit(cache=True)
+def _avgs_to_relative(avgs):
+    """Diff, filter and int8 cast of note numbers, fused in one pass."""
+    out = np.empty(max(avgs.shape[0] - 1, 0), dtype=np.int8)
+    k = 0
+    for i in range(avgs.shape[0] - 1):
+        d = avgs[i + 1] - avgs[i]
+        if d != 0 and -22 < d < 22:
+            out[k] = d
+            k += 1
+    return out[:k]
+
+def _find_relative_pitch(avg_pitch_values: np.ndarray) -> np.ndarray:
+    """Create and return an array of relative pitch changes."""
+    # Drop repeated notes and implausible jumps (likely tracking errors);
+    # what's left is within +/-21 semitones, so int8 holds it
+    return _avgs_to_relative(np.asarray(avg_pitch_values, dtype=np.int64))
+
+# JIT once per process here, not in the middle of the first song
+_avgs_to_relative(np.zeros(2, dtype=np.int64))
 
 def extract_features(audio):
     """Extract all features from audio."""
     try:
+        # One STFT and onset envelope shared by all three analyses
+        S = pitch.compute_spectrogram(audio)
+        onset_env = pitch.compute_onset_envelope(S)
+        
         # Detect tempo
-        tempo = pitch.detect_bpm(audio)
+        tempo = pitch.detect_bpm(audio, onset_env=onset_env)
         
         # Extract pitches
-        pitch_times, pitch_values, pitch_confidence = pitch.extract_pitches(audio)
+        pitch_times, pitch_values, pitch_confidence = pitch.extract_pitches(audio, S=S)
         
         # Detect onsets
-        onsets = pitch.detect_onsets(audio)
+        onsets = pitch.detect_onsets(audio, onset_env=onset_env)
         
         # Calculate features
         num_of_pitches = _pitches_per_interval(len(audio), pitch_values, onsets)
@@ -101,7 +113,7 @@ def extract_features(audio):
         if len(avg_pitches) > 1:
             relative_pitches = _find_relative_pitch(avg_pitches)
         else:
-            relative_pitches = []
+            relative_pitches = np.zeros(0, dtype=np.int8)
         
         return {
             'tempo': float(tempo),
@@ -113,3 +125,46 @@ def extract_features(audio):
     except Exception as e:
         print(f"Error extracting features: {e}")
         return None
+
+def _features_cache_path(audio_path) -> Path:
+    """Cache file for a song's features, keyed on file mtime and settings."""
+    audio_path = Path(audio_path)
+    key = (
+        f"{audio_path.resolve()}:{audio_path.stat().st_mtime_ns}:"
+        f"{SAMPLE_RATE}:{HOP_LENGTH}:v{FEATURES_VERSION}"
+    )
+    return PITCH_CACHE_DIR / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+def extract_features_from_file(audio_path):
+    """Load an audio file and extract its features, cached on disk.
+
+    Used by the indexing scripts so unchanged songs are never re-analyzed.
+    """
+    cache_path = _features_cache_path(audio_path)
+    try:
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            features = json.load(f)
+        features['relative_pitches'] = np.asarray(features['relative_pitches'], dtype=np.int8)
+        return features
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError) as e:
+        # e.g. truncated by a killed run: recompute and overwrite it
+        print(f"Ignoring unreadable feature cache {cache_path.name}: {e}")
+    
+    audio, sr = pitch.load_audio(str(audio_path))
+    if audio is None:
+        return None
+    
+    features = extract_features(audio)
+    if features and features.get('pitch_count'):
+        # Write then rename, so a killed run never leaves a partial file
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix='.json.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({**features, 'relative_pitches': features['relative_pitches'].tolist()}, f)
+            os.replace(tmp_path, cache_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    return features
@@ -19,6 +19,20 @@ def load_audio(audio_path):
 
 def load_audio_from_bytes(audio_bytes):
     """Load audio from bytes."""
+    try:
+        # Decode straight from memory; same (default) resampling as load_audio
+        audio, sr = sf.read(io.BytesIO(audio_bytes), dtype='float32')
+        if audio.ndim > 1:
+            audio = audio.mean(axis=1)
+        if sr != SAMPLE_RATE:
+            audio = librosa.resample(audio, orig_sr=sr, target_sr=SAMPLE_RATE)
+        return audio, SAMPLE_RATE
+    except sf.LibsndfileError:
+        pass # Not a format libsndfile reads; let librosa try a temp file
+    except Exception as e:
+        print(f"Error loading audio from bytes: {e}")
+        return None, None
+    
     try:
         # Save to temp file and load
         with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp:
@@ -32,11 +46,21 @@ def load_audio_from_bytes(audio_bytes):
         print(f"Error loading audio from bytes: {e}")
         return None, None
 
-def detect_bpm(audio):
+def compute_spectrogram(audio):
+    """Magnitude STFT shared by pitch tracking and onset analysis."""
+    return np.abs(librosa.stft(audio, n_fft=n_fft, hop_length=HOP_LENGTH))
+
+def compute_onset_envelope(S):
+    """Onset strength from a magnitude STFT (same as onset_strength(y=...))."""
+    mel = librosa.feature.melspectrogram(S=S**2, sr=SAMPLE_RATE)
+    return librosa.onset.onset_strength(S=librosa.power_to_db(mel), sr=SAMPLE_RATE)
+
+def detect_bpm(audio, onset_env=None):
     """Detect tempo using librosa."""
     try:
         # Use onset detection for tempo
-        onset_env = librosa.onset.onset_strength(y=audio, sr=SAMPLE_RATE)
+        if onset_env is None:
+            onset_env = librosa.onset.onset_strength(y=audio, sr=SAMPLE_RATE)
         tempo, _ = librosa.beat.beat_track(onset_envelope=onset_env, sr=SAMPLE_RATE)
         # Handle numpy scalar or array return
         if np.ndim(tempo) > 0 and len(tempo) > 0:
@@ -47,31 +71,24 @@ def detect_bpm(audio):
     except:
         return 120.0
 
-def extract_pitches(audio):
+def extract_pitches(audio, S=None):
     """Extract pitch using librosa's piptrack."""
     try:
-        # Extract pitch using CQT (Constant-Q Transform)
-        # Note: cqt unused in original code but computed
-        cqt = np.abs(librosa.cqt(audio, sr=SAMPLE_RATE, hop_length=HOP_LENGTH))
-        
-        # Get pitch frequencies
+        # Get pitch frequencies (reusing the magnitude STFT if given)
         pitches, magnitudes = librosa.piptrack(
             y=audio, 
+            S=S,
             sr=SAMPLE_RATE,
             hop_length=HOP_LENGTH,
             fmin=80.0,
             fmax=1000.0
         )
         
-        # Get predominant pitch per frame
-        pitch_values = []
-        for t in range(pitches.shape[1]):
-            index = magnitudes[:, t].argmax()
-            pitch = pitches[index, t]
-            if pitch > 0:
-                pitch_values.append(pitch)
-            else:
-                pitch_values.append(0)
+        # Get predominant pitch per frame (strongest bin in each column);
+        # the gather already yields a fresh array, float32 for float32 audio
+        index = magnitudes.argmax(axis=0)
+        pitch_values = pitches[index, np.arange(pitches.shape[1])].astype(np.float32, copy=False)
+        pitch_values[pitch_values <= 0] = 0
         
         # Calculate times
         pitch_times = librosa.frames_to_time(
@@ -81,22 +98,23 @@ def extract_pitches(audio):
         )
         
         # Simple confidence based on magnitude
-        pitch_confidence = [1.0 if p > 0 else 0.0 for p in pitch_values]
+        pitch_confidence = (pitch_values > 0).astype(np.float32)
         
-        return pitch_times, np.array(pitch_values), np.array(pitch_confidence)
+        return pitch_times, pitch_values, pitch_confidence
     except Exception as e:
         print(f"Error extracting pitches: {e}")
         # Return dummy data
         dummy_times = np.linspace(0, len(audio)/SAMPLE_RATE, 100)
-        dummy_pitches = np.zeros(100)
-        dummy_confidence = np.zeros(100)
+        dummy_pitches = np.zeros(100, dtype=np.float32)
+        dummy_confidence = np.zeros(100, dtype=np.float32)
         return dummy_times, dummy_pitches, dummy_confidence
 
-def detect_onsets(audio):
+def detect_onsets(audio, onset_env=None):
     """Detect onsets using librosa."""
     try:
         onset_frames = librosa.onset.onset_detect(
             y=audio, 
+            onset_envelope=onset_env,
             sr=SAMPLE_RATE,
             hop_length=HOP_LENGTH,
             backtrack=True
@@ -116,75 +134,73 @@ def detect_onsets(audio):
 def convert_webm_to_wav(webm_data):
     """Convert WebM/Opus audio to WAV format using ffmpeg."""
     try:
-        # Create temporary files
-        with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as webm_file:
-            webm_file.write(webm_data)
-            webm_path = webm_file.name
-        
-        wav_path = webm_path.replace('.webm', '.wav')
+        # Stream through ffmpeg's stdin/stdout; no temp files. Resample to
+        # SAMPLE_RATE here so loading needs no second resample.
+        result = None
+        for tool in ('ffmpeg', 'avconv'):
+            cmd = [
+                tool, '-y', '-i', 'pipe:0',
+                '-f', 'wav',
+                '-acodec', 'pcm_s16le',
+                '-ac', '1',
+                '-ar', str(SAMPLE_RATE),
+                'pipe:1'
+            ]
+            try:
+                result = subprocess.run(cmd, input=webm_data, capture_output=True)
+            except FileNotFoundError:
+                print(f"{tool} not found.")
+                continue
+            
+            if result.returncode == 0 and result.stdout:
+                return result.stdout
         
-        # Use ffmpeg to convert WebM to WAV
-        # Try using ffmpeg (preferred)
-        cmd = [
-            'ffmpeg', '-y', '-i', webm_path,
-            '-acodec', 'pcm_s16le',
-            '-ac', '1',
-            '-ar', '22050',
-            wav_path
-        ]
+        if result:
+            print(f"Conversion failed: {result.stderr.decode(errors='replace')}")
         
-        # Run conversion
-        # Use shell=True only on windows if needed? No, avoid shell=True if possible.
-        # But 'ffmpeg' needs to be in PATH.
+        # Fallback to pydub
         try:
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            from pydub import AudioSegment
+            audio = AudioSegment.from_file(io.BytesIO(webm_data), format="webm")
+            audio = audio.set_frame_rate(SAMPLE_RATE).set_channels(1)
             
-            if result.returncode != 0:
-                 # Try avconv fallback
-                 cmd = [
-                    'avconv', '-y', '-i', webm_path,
-                    '-acodec', 'pcm_s16le',
-                    '-ac', '1',
-                    '-ar', '22050',
-                    wav_path
-                 ]
-                 result = subprocess.run(cmd, capture_output=True, text=True)
-        except  FileNotFoundError:
-             print("ffmpeg not found.")
-             result = None # Handled below
-             
-        if os.path.exists(wav_path):
-            with open(wav_path, 'rb') as f:
-                wav_data = f.read()
-            
-            # Clean up temp files
-            os.unlink(webm_path)
-            os.unlink(wav_path)
-            
-            return wav_data
-        else:
-            if result:
-                 print(f"Conversion failed: {result.stderr}")
-            
-            # Fallback to pydub
-            try:
-                from pydub import AudioSegment
-                audio = AudioSegment.from_file(webm_path, format="webm")
-                audio = audio.set_frame_rate(22050).set_channels(1)
-                
-                # Export to WAV
-                wav_buffer = io.BytesIO()
-                audio.export(wav_buffer, format="wav")
-                wav_data = wav_buffer.getvalue()
-                
-                os.unlink(webm_path)
-                return wav_data
-            except Exception as e:
-                print(f"Pydub conversion error: {e}")
-                if os.path.exists(webm_path):
-                    os.unlink(webm_path)
-                return None
+            # Export to WAV
+            wav_buffer = io.BytesIO()
+            audio.export(wav_buffer, format="wav")
+            return wav_buffer.getvalue()
+        except Exception as e:
+            print(f"Pydub conversion error: {e}")
+            return None
                 
     except Exception as e:
         print(f"WebM to WAV conversion error: {e}")
         return None
+
+def decode_webm(webm_data):
+    """
+    Decode WebM/Opus straight to a mono float32 signal at SAMPLE_RATE.
+    ffmpeg does decode, downmix and resample in one pass and emits raw
+    f32le samples, so there is no WAV to write or parse.
+    """
+    cmd = [
+        'ffmpeg', '-loglevel', 'error', '-i', 'pipe:0',
+        '-f', 'f32le',
+        '-ac', '1',
+        '-ar', str(SAMPLE_RATE),
+        'pipe:1'
+    ]
+    try:
+        result = subprocess.run(cmd, input=webm_data, capture_output=True)
+    except FileNotFoundError:
+        # No ffmpeg: fall back to the WAV conversion path (avconv, pydub)
+        print("ffmpeg not found.")
+        wav_data = convert_webm_to_wav(webm_data)
+        if wav_data:
+            return load_audio_from_bytes(wav_data)
+        return None, None
+    
+    if result.returncode == 0 and result.stdout:
+        return np.frombuffer(result.stdout, dtype=np.float32), SAMPLE_RATE
+    # A bad upload; the fallbacks would only run ffmpeg on it again
+    print(f"ffmpeg decode failed: {result.stderr.decode(errors='replace')}")
+    return None, None